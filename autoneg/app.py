@@ -41,6 +41,35 @@ negotiation layer over /var/www might be started with
 And then the web server would be configured to pass requests
 which it couldn't handle to this script over the */tmp/test.sock*
 socket.
+
+The application can also be embedded in another WSGI server without
+going through the command line. Passing the configuration directly
+leaves :data:`sys.argv`, the class defaults and the logging setup
+alone::
+
+  from autoneg.app import AutoNeg
+  application = AutoNeg.from_config({ "base": "/var/www" })
+
+An :class:`RdfAutoNeg` application created this way renders graphs
+in the serving process unless :meth:`RdfAutoNeg.start_pool` is called
+in each worker process, for example from a post-fork hook.
+
+Graphs bigger than *serialise.threshold* triples that are to be
+rendered as RDF/XML or N3 are sent to the pool. Checking the size
+counts the graph in the serving process, which is only cheap if
+the store can count a context without walking it (Virtuoso can,
+Sleepycat and IOMemory cannot). With such stores set the threshold
+to *None* to send every RDF/XML and N3 rendering to the pool
+without counting.
+
+Rather than reading the chosen file and sending it back over the
+(Fast)CGI connection, the script can leave delivery to the web server.
+Setting *sendfile* to *X-Accel-Redirect* (nginx) makes the response
+carry only the negotiated headers and a redirect to the internal
+location given by *sendfile_prefix*, which must map onto *base*.
+Setting it to *X-Sendfile* (Apache, lighttpd) or
+*X-LIGHTTPD-send-file* (older lighttpd) sends the absolute path of
+the file instead.
 """
 
 
@@ -53,6 +82,8 @@ from optparse import OptionParser
 from ConfigParser import ConfigParser
 import os, sys, time
 import logging
+from threading import Lock, BoundedSemaphore
+from urllib import quote
 from glob import glob
 
 from autoneg.accept import negotiate
@@ -61,6 +92,34 @@ log = logging.getLogger("autoneg")
 
 BUFSIZ = 4096
 
+## headers understood by front-end web servers for delivering a file
+## on our behalf. only X-Accel-Redirect takes a URI, the others a path
+SENDFILE_HEADERS = ("x-accel-redirect", "x-sendfile", "x-lighttpd-send-file")
+
+class _PoolBusy(Exception):
+    """Raised when the serialisation pool has no room for more work"""
+
+## store connection of a serialisation pool worker, see _init_worker
+_worker_store = None
+
+def _init_worker(store_name, store_args):
+    global _worker_store
+    from rdflib.store import Store
+    from rdflib.plugin import get as get_plugin
+    _worker_store = get_plugin(store_name, Store)(store_args)
+
+def _serialise(identifier, format, deadline):
+    ## runs in a worker process of RdfAutoNeg's serialisation pool. the
+    ## graph is read through the worker's own store connection so the
+    ## web process only sends the graph uri and receives the result
+    if time.time() > deadline:
+        ## the requesting worker has timed out and gone away already
+        return None
+    from rdflib.graph import Graph
+    from rdflib.term import URIRef
+    g = Graph(_worker_store, identifier=URIRef(identifier))
+    return g.serialize(format=format)
+
 class AutoNeg(object):
     opt_parser = OptionParser(usage=__doc__)
     opt_parser.add_option("-c", "--config",
@@ -81,6 +140,14 @@ class AutoNeg(object):
     opt_parser.add_option("-i", "--index",
                           dest="index",
                           help="index file to use (default: index)")
+    opt_parser.add_option("-x", "--sendfile",
+                          dest="sendfile",
+                          help="let the web server deliver files with this header "
+                          "(X-Accel-Redirect, X-Sendfile or X-LIGHTTPD-send-file)")
+    opt_parser.add_option("-p", "--sendfile-prefix",
+                          dest="sendfile_prefix",
+                          help="internal location of the base directory "
+                          "for X-Accel-Redirect")
     opt_parser.add_option("-l", "--logfile",
                           dest="logfile", default=None,
                           help="log to file")
@@ -98,16 +165,45 @@ class AutoNeg(object):
         "loglevel": "info",
         "logformat": "%(asctime)s %(levelname)s  [%(name)s] %(message)s",
         "methods": ('HEAD', 'GET'),
+        "sendfile": None,
+        "sendfile_prefix": "/autoneg-files",
         }
-    def __init__(self):
+    def __init__(self, config=None):
+        ## never update the class-level defaults in place so that
+        ## several independent instances can live in one process
+        self.config = dict(self.config)
+        if config is None:
+            self.configure_from_args()
+        else:
+            self.config.update(config)
+        self.config["mime_types"] = [ct.split("/", 1) + [exts]
+                                     for (ct, exts) in self.config["mime_types"]]
+        sendfile = self.config.get("sendfile")
+        if sendfile and sendfile.lower() not in SENDFILE_HEADERS:
+            raise ValueError("unknown sendfile header %r, must be one of "
+                             "X-Accel-Redirect, X-Sendfile or X-LIGHTTPD-send-file"
+                             % sendfile)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Construct an application from an explicit *config* mapping
+        without looking at :data:`sys.argv` or touching the logging
+        configuration. Keys not present in *config* take the class
+        defaults. This is suitable for creating the application once
+        in the master process of a preloading WSGI server: connections
+        to external resources such as the :class:`RdfAutoNeg` store
+        are only opened in the process that serves requests.
+        """
+        return cls(config=config)
+
+    def configure_from_args(self):
         self.opts, self.args = self.opt_parser.parse_args()
         if self.opts.config:
             fp = open(self.opts.config)
             cfg = eval(fp.read())
             fp.close()
             self.config.update(cfg)
-        self.config["mime_types"] = [ct.split("/", 1) + [exts]
-                                     for (ct, exts) in self.config["mime_types"]]
 
         for k,v in self.opts.__dict__.items():
             if v: self.config[k] = v
@@ -152,7 +248,7 @@ class AutoNeg(object):
 
             start_response('500 Internal Server Error',
                            [('Content-Type', 'text/plain; charset=utf-8')])
-            if self.opts.debug:
+            if self.config.get("debug"):
                 return [format_exc()]
             else:
                 return ["Oops. The admin should look at the logs"]
@@ -172,24 +268,48 @@ class AutoNeg(object):
 
         return path
 
+    def file_headers(self, fname, st):
+        return [
+            ('Content-Location', os.path.basename(fname)),
+            ('Last-Modified', time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+                                            time.gmtime(st.st_mtime))),
+            ('Vary', 'Accept'),
+            ('ETag', '%s' % st.st_mtime),
+            ]
+
+    def sendfile_headers(self, content_type, fname):
+        ## negotiation is done, hand the file itself over to the
+        ## web server. X-Sendfile takes a filesystem path while
+        ## X-Accel-Redirect takes a URI of an internal location
+        header = self.config["sendfile"]
+        if header.lower() == "x-accel-redirect":
+            relpath = os.path.relpath(fname, self.config["base"])
+            target = "%s/%s" % (self.config["sendfile_prefix"].rstrip("/"),
+                                quote(relpath.replace(os.sep, "/")))
+        else:
+            target = os.path.abspath(fname)
+        headers = [('Content-Type', content_type)]
+        headers.extend(self.file_headers(fname, os.stat(fname)))
+        headers.append((header, target))
+        return headers
+
     def request(self, environ, start_response, method, negotiated):
         path = self.get_path(environ)
         for content_type, exts in negotiated:
             for ext in exts:
                 fname = path + "." + ext
                 if os.path.isfile(fname):
+                    if self.config.get("sendfile"):
+                        start_response('200 OK', self.sendfile_headers(content_type, fname))
+                        yield ""
+                        return
                     try:
                         fp = open(fname)
                         st = os.fstat(fp.fileno())
                         headers = [
                             ('Content-Type', content_type),
                             ('Content-Length', "%s" % st.st_size),
-                            ('Content-Location', os.path.basename(fname)),
-                            ('Last-Modified', time.strftime("%a, %d %b %Y %H:%M:%S GMT",
-                                                            time.gmtime(st.st_mtime))),
-                            ('Vary', 'Accept'),
-                            ('ETag', '%s' % st.st_mtime),
-                            ]
+                            ] + self.file_headers(fname, st)
                         start_response('200 OK', headers)
                         if method == 'GET':
                             while True:
@@ -285,6 +405,12 @@ class RdfAutoNeg(AutoNeg):
         "loglevel": "info",
         "logformat": "%(asctime)s %(levelname)s  [%(name)s] %(message)s",
         "methods": ('HEAD', 'GET'),
+        "serialise.processes": None,
+        ## None sends every pooled serialisation to the pool without
+        ## counting the graph first, for stores that can't count cheaply
+        "serialise.threshold": 10000,
+        "serialise.timeout": 60,
+        "serialise.backlog": 2,
         }
 
     # dictionary of content-types to rdflib serialisations
@@ -294,8 +420,11 @@ class RdfAutoNeg(AutoNeg):
         "text/n3": "n3",
         "text/rdf+n3": "n3",
         }
-    def __init__(self, *av, **kw):
-        super(RdfAutoNeg, self).__init__(*av, **kw)
+    # serialisations that are slow enough to be worth sending large
+    # graphs to the process pool rather than rendering them inline
+    pooled_serialisations = ("pretty-xml", "n3")
+    def __init__(self, config=None):
+        super(RdfAutoNeg, self).__init__(config)
         try:
             from rdflib.graph import Graph
             from rdflib.store import Store
@@ -303,8 +432,80 @@ class RdfAutoNeg(AutoNeg):
         except ImportError:
             log.error("You must install rdflib 3.0 or greater to use these facilities")
             sys.exit(1)
-        cls = get_plugin(self.config["rdflib.store"], Store)
-        self.store = cls(self.config["rdflib.args"])
+        self.store_class = get_plugin(self.config["rdflib.store"], Store)
+        self._store = None
+        self._store_pid = None
+        self._lock = Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._slots = None
+        self._inline_pid = None
+
+    def get_store(self):
+        ## the store connection is opened lazily and once per process
+        ## so that an application created before forking doesn't share
+        ## one database socket between all of the workers
+        with self._lock:
+            if self._store is None or self._store_pid != os.getpid():
+                self._store = self.store_class(self.config["rdflib.args"])
+                self._store_pid = os.getpid()
+            return self._store
+
+    def start_pool(self):
+        """
+        Start the serialisation pool for this process unless it is
+        disabled or already running. This forks, so it must be called
+        before the server starts handling requests in threads, for
+        example from :func:`autoneg.command.rdfan_fcgi` or from the
+        post-fork hook of a preloading server. Processes that never
+        call it render every graph inline.
+        """
+        if self.config["serialise.processes"] == 0:
+            return
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                from multiprocessing import Pool, cpu_count
+                processes = self.config["serialise.processes"] or cpu_count()
+                self._pool = Pool(processes, _init_worker,
+                                  (self.config["rdflib.store"], self.config["rdflib.args"]))
+                self._slots = BoundedSemaphore(processes * self.config["serialise.backlog"])
+                self._pool_pid = os.getpid()
+
+    def get_pool(self):
+        ## the pool started in this process, if any. a pool inherited
+        ## across a fork belongs to the parent and is never used
+        if self._pool is not None and self._pool_pid == os.getpid():
+            return self._pool
+        if self.config["serialise.processes"] != 0 and self._inline_pid != os.getpid():
+            self._inline_pid = os.getpid()
+            log.warning("serialisation pool not started in process %s, "
+                        "rendering large graphs inline", os.getpid())
+        return None
+
+    def serialise(self, g, format):
+        pool = None
+        threshold = self.config["serialise.threshold"]
+        if format in self.pooled_serialisations and \
+                (threshold is None or len(g) > threshold):
+            pool = self.get_pool()
+        if pool is None:
+            return g.serialize(format=format)
+
+        ## bound the work waiting for the pool as well as the number of
+        ## workers. the slot belongs to the requesting thread and is
+        ## given back when it stops waiting, whatever happened to the
+        ## task. tasks that a worker only picks up after the request
+        ## has timed out are skipped rather than rendered
+        slots = self._slots
+        if not slots.acquire(False):
+            raise _PoolBusy()
+        try:
+            timeout = self.config["serialise.timeout"]
+            result = pool.apply_async(_serialise,
+                                      (unicode(g.identifier), format, time.time() + timeout))
+            return result.get(timeout)
+        finally:
+            slots.release()
 
     def get_path(self, environ):
         ## do a little rewriting of the request
@@ -329,6 +530,7 @@ class RdfAutoNeg(AutoNeg):
     def request(self, environ, start_response, method, negotiated):
         from rdflib.graph import Graph
         from rdflib.term import URIRef
+        from multiprocessing import TimeoutError
 
         negotiated = list(negotiated)
 
@@ -354,11 +556,26 @@ class RdfAutoNeg(AutoNeg):
             content_type = negotiated[0][0]
 
         # initialise the graph over the store
-        g = Graph(self.store, identifier=URIRef(path))
+        g = Graph(self.get_store(), identifier=URIRef(path))
+
+        # serialise the graph before committing to a response
+        format = self.serialisations.get(content_type, "pretty-xml")
+        try:
+            data = self.serialise(g, format)
+        except (TimeoutError, _PoolBusy), e:
+            reason = "timed out" if isinstance(e, TimeoutError) else "pool busy"
+            log.error("%s %s %s %s serialising %s" % (environ.get("REMOTE_ADDR"),
+                                                      environ.get("REQUEST_METHOD"),
+                                                      environ.get("DOCUMENT_URI", "/"),
+                                                      reason, format))
+            start_response('503 Service Unavailable',
+                           [('Content-type', 'text/plain; charset=utf-8')])
+            yield "Too busy rendering the graph, try again later"
+            return
 
         # send the serialised graph
         start_response('200 OK', [
                 ("Content-type", content_type),
                 ("Vary", "Accept"),
                 ])
-        yield g.serialize(format=self.serialisations.get(content_type, "pretty-xml"))
+        yield data
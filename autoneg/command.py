@@ -14,4 +14,6 @@ def rdfan_cgi():
 
 def rdfan_fcgi():
     from flup.server.fcgi import WSGIServer
-    WSGIServer(RdfAutoNeg(), multiplexed=False).run()
+    app = RdfAutoNeg()
+    app.start_pool()
+    WSGIServer(app, multiplexed=False).run()
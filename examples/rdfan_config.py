@@ -11,4 +11,8 @@
     "loglevel": "info",
     "logformat": "%(asctime)s %(levelname)s  [%(name)s] %(message)s",
     "methods": ('HEAD', 'GET'),
+    "serialise.processes": 4,
+    "serialise.threshold": 10000, # None to skip counting the graph
+    "serialise.timeout": 60,
+    "serialise.backlog": 2,
 }